@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import queue
+import random
+import secrets
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+_STOP = object()
+
+
+class AccessLog:
+    """Structured JSON-lines access log written by a background thread.
+
+    Request threads only sample and enqueue a tuple; hashing, serialization,
+    batching, and rotation all happen on the writer thread. Records never
+    carry card numbers, PINs, or K tokens.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 1.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 3,
+        batch_size: int = 256,
+        flush_interval: float = 0.5,
+        max_queue: int = 100_000,
+    ) -> None:
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        self.path = Path(path).expanduser()
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+        # SimpleQueue.put is a C fast path with no Python-level lock, unlike queue.Queue.
+        self._queue: queue.SimpleQueue[object] = queue.SimpleQueue()
+        # Per-process key so client ids are not linkable across restarts.
+        self._client_key = secrets.token_bytes(16)
+        self._thread: threading.Thread | None = None
+        self._stream: Any = None
+        self._size = 0
+        self._error_reported = False
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        # Open here so a bad path fails at startup instead of in the writer thread.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="fingerpay-access-log", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join()
+        self._thread = None
+
+    def record(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        latency: float,
+        kdf_time: float,
+        bytes_in: int,
+        bytes_out: int,
+        client_ip: str,
+    ) -> None:
+        if self._thread is None:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        # Bound memory if the writer stalls; qsize() is approximate, which is fine here.
+        if self._queue.qsize() >= self.max_queue:
+            with self._dropped_lock:
+                self.dropped += 1
+            return
+        self._queue.put(
+            (time.time(), method, route, status, latency, kdf_time, bytes_in, bytes_out, client_ip)
+        )
+
+    def _hash_client(self, client_ip: str) -> str:
+        return hashlib.blake2s(client_ip.encode("utf-8"), key=self._client_key, digest_size=8).hexdigest()
+
+    def _format(self, entry: tuple) -> str:
+        ts, method, route, status, latency, kdf_time, bytes_in, bytes_out, client_ip = entry
+        return json.dumps(
+            {
+                "ts": round(ts, 3),
+                "method": method,
+                "route": route,
+                "status": status,
+                "latency_ms": round(latency * 1000, 3),
+                "kdf_ms": round(kdf_time * 1000, 3),
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "client": self._hash_client(client_ip),
+            },
+            separators=(",", ":"),
+        )
+
+    def _run(self) -> None:
+        stopping = False
+        try:
+            while not stopping:
+                try:
+                    first = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+
+                batch = []
+                item = first
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                if not batch:
+                    continue
+                chunk = "".join(self._format(entry) + "\n" for entry in batch)
+                try:
+                    self._write(chunk)
+                except OSError as exc:
+                    # Keep draining so the queue cannot grow; the batch is lost.
+                    self._close_stream()
+                    if not self._error_reported:
+                        self._error_reported = True
+                        print(f"Access log write to {self.path} failed: {exc}", file=sys.stderr)
+        finally:
+            self._close_stream()
+            self._thread = None
+
+    def _open(self) -> None:
+        self._stream = open(self.path, "a", encoding="utf-8")
+        self._size = self._stream.tell()
+
+    def _close_stream(self) -> None:
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except OSError:
+                pass
+            self._stream = None
+
+    def _write(self, chunk: str) -> None:
+        if self._stream is not None and self.max_bytes > 0 and self._size > 0:
+            if self._size + len(chunk) > self.max_bytes:
+                self._close_stream()
+                self._rotate()
+        if self._stream is None:
+            self._open()
+        self._stream.write(chunk)
+        self._stream.flush()
+        self._size += len(chunk)
+
+    def _rotate(self) -> None:
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for idx in range(self.backup_count - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{idx}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{idx + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
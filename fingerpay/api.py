@@ -1,20 +1,159 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Any
+from typing import Any, Callable
 
+from .access_log import AccessLog
 from .core import FingerPayError, create_k, recover_card
 
+ROUTES = ("/create-k", "/recover-card")
+# Keys must be unguessable (e.g. a UUID4); a known key plus a 200/422 reply
+# would otherwise confirm card/PIN guesses without paying for scrypt.
+MIN_IDEMPOTENCY_KEY_LEN = 16
+MAX_IDEMPOTENCY_KEY_LEN = 255
+
+
+class IdempotencyConflict(FingerPayError):
+    pass
+
+
+class _IdempotencyEntry:
+    __slots__ = ("fingerprint", "done", "result", "error", "expires_at")
+
+    def __init__(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result: str | None = None
+        self.error: Exception | None = None
+        self.expires_at = float("inf")
+
+
+class IdempotencyCache:
+    """Bounded TTL+LRU cache of `/create-k` results keyed by Idempotency-Key.
+
+    Entries are also keyed by client address, which only separates callers
+    that connect directly; behind a gateway all requests share one scope.
+    Only a keyed hash of the request is stored, never the card or PIN.
+    Concurrent requests with the same key wait on the first one's result.
+    A zero `max_entries` or `ttl_seconds` disables the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 600.0) -> None:
+        if max_entries < 0:
+            raise ValueError("max_entries must be >= 0")
+        if ttl_seconds < 0:
+            raise ValueError("ttl_seconds must be >= 0")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[tuple[str, str], _IdempotencyEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint_key = secrets.token_bytes(16)
+
+    def fingerprint(self, *fields: str) -> str:
+        data = json.dumps(fields, separators=(",", ":")).encode("utf-8")
+        return hashlib.blake2s(data, key=self._fingerprint_key, digest_size=16).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def run(self, scope: str, key: str, fingerprint: str, compute: Callable[[], str]) -> str:
+        scoped_key = (scope, key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(scoped_key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[scoped_key]
+                entry = None
+
+            if entry is None:
+                entry = _IdempotencyEntry(fingerprint)
+                self._entries[scoped_key] = entry
+                self._evict()
+                leader = True
+            else:
+                leader = False
+                if entry.fingerprint == fingerprint:
+                    self._entries.move_to_end(scoped_key)
+
+        if not leader and entry.fingerprint != fingerprint:
+            # Pay for the KDF before answering; otherwise the 422 would be a
+            # free oracle for card/PIN guesses against a known key.
+            compute()
+            raise IdempotencyConflict("Idempotency-Key was reused with a different request")
+
+        if not leader:
+            entry.done.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.result  # type: ignore[return-value]
+
+        try:
+            entry.result = compute()
+        except BaseException as exc:
+            entry.error = exc
+            # Failed attempts are not cached; the next retry computes afresh.
+            with self._lock:
+                if self._entries.get(scoped_key) is entry:
+                    del self._entries[scoped_key]
+            raise
+        finally:
+            entry.expires_at = time.monotonic() + self.ttl_seconds
+            entry.done.set()
+        return entry.result
+
+    def _evict(self) -> None:
+        # Only completed entries are evicted so in-flight work stays single-flight;
+        # the cache may briefly exceed max_entries by the number of running requests.
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        stale = []
+        for old_key, old in self._entries.items():
+            if len(stale) >= excess:
+                break
+            if old.done.is_set():
+                stale.append(old_key)
+        for old_key in stale:
+            del self._entries[old_key]
+
 
 class FingerPayAPIHandler(BaseHTTPRequestHandler):
     server_version = "FingerPayAPI/0.1"
 
     def do_OPTIONS(self) -> None:  # noqa: N802
-        self._send_json(204, {})
+        self._reset_access_state()
+        try:
+            self._send_json(204, {})
+        finally:
+            self._log_access()
 
     def do_POST(self) -> None:  # noqa: N802
+        self._reset_access_state()
+        # Log aborted requests too (client disconnects, timeouts).
+        try:
+            self._dispatch_post()
+        finally:
+            self._log_access()
+
+    def send_error(self, code: int, message: str | None = None, explain: str | None = None) -> None:
+        # Only reached for requests rejected by BaseHTTPRequestHandler itself
+        # (malformed request line, unsupported method); handlers use _send_error_json.
+        self._reset_access_state()
+        self._status = code
+        try:
+            super().send_error(code, message, explain)
+        finally:
+            self._log_access()
+
+    def _dispatch_post(self) -> None:
         if self.path == "/create-k":
             self._handle_create_k()
             return
@@ -34,8 +173,37 @@ class FingerPayAPIHandler(BaseHTTPRequestHandler):
             self._send_error_json(400, "PIN must be at least 4 characters")
             return
 
+        idempotency_key = self.headers.get("Idempotency-Key", "").strip()
+        if idempotency_key and not (
+            MIN_IDEMPOTENCY_KEY_LEN <= len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LEN
+        ):
+            self._send_error_json(
+                400,
+                f"Idempotency-Key must be {MIN_IDEMPOTENCY_KEY_LEN}-{MAX_IDEMPOTENCY_KEY_LEN} characters",
+            )
+            return
+        cache: IdempotencyCache | None = getattr(self.server, "idempotency_cache", None)
+
+        def compute() -> str:
+            kdf_start = time.perf_counter()
+            try:
+                return create_k(card, pin, enforce_luhn=True)
+            finally:
+                self._kdf_time = time.perf_counter() - kdf_start
+
         try:
-            k_token = create_k(card, pin, enforce_luhn=True)
+            if cache is not None and cache.enabled and idempotency_key:
+                k_token = cache.run(
+                    self.client_address[0],
+                    idempotency_key,
+                    cache.fingerprint(card, pin),
+                    compute,
+                )
+            else:
+                k_token = compute()
+        except IdempotencyConflict as exc:
+            self._send_error_json(422, str(exc))
+            return
         except FingerPayError as exc:
             self._send_error_json(400, str(exc))
             return
@@ -56,11 +224,14 @@ class FingerPayAPIHandler(BaseHTTPRequestHandler):
             self._send_error_json(400, "PIN must be at least 4 characters")
             return
 
+        kdf_start = time.perf_counter()
         try:
             card = recover_card(k_token, pin)
         except FingerPayError as exc:
             self._send_error_json(400, str(exc))
             return
+        finally:
+            self._kdf_time = time.perf_counter() - kdf_start
 
         self._send_json(200, {"card": card})
 
@@ -77,6 +248,7 @@ class FingerPayAPIHandler(BaseHTTPRequestHandler):
 
         try:
             raw = self.rfile.read(int(content_length))
+            self._bytes_in = len(raw)
             body = json.loads(raw.decode("utf-8"))
         except Exception:
             self._send_error_json(400, "Malformed JSON body")
@@ -90,26 +262,62 @@ class FingerPayAPIHandler(BaseHTTPRequestHandler):
 
     def _send_json(self, status_code: int, payload: dict[str, Any]) -> None:
         data = json.dumps(payload).encode("utf-8")
+        self._status = status_code
         self.send_response(status_code)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(data)))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, Idempotency-Key")
         self.end_headers()
 
         if status_code != 204:
             self.wfile.write(data)
+            self._bytes_out = len(data)
 
     def _send_error_json(self, status_code: int, message: str) -> None:
         self._send_json(status_code, {"error": message})
 
+    def _reset_access_state(self) -> None:
+        self._started_at = time.perf_counter()
+        self._kdf_time = 0.0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._status = 0
+
+    def _log_access(self) -> None:
+        access_log: AccessLog | None = getattr(self.server, "access_log", None)
+        if access_log is None:
+            return
+        # Only known routes are logged verbatim; anything else could echo client input.
+        path = getattr(self, "path", "")
+        route = path if path in ROUTES else "other"
+        access_log.record(
+            self.command or "-",
+            route,
+            self._status,
+            time.perf_counter() - self._started_at,
+            self._kdf_time,
+            self._bytes_in,
+            self._bytes_out,
+            self.client_address[0],
+        )
+
     def log_message(self, format: str, *args: Any) -> None:
         return
 
 
-def run_server(host: str = "127.0.0.1", port: int = 8787) -> None:
+def run_server(
+    host: str = "127.0.0.1",
+    port: int = 8787,
+    access_log: AccessLog | None = None,
+    idempotency_cache: IdempotencyCache | None = None,
+) -> None:
+    if access_log is not None:
+        access_log.start()
     server = ThreadingHTTPServer((host, port), FingerPayAPIHandler)
+    server.access_log = access_log
+    server.idempotency_cache = idempotency_cache if idempotency_cache is not None else IdempotencyCache()
     print(f"FingerPay API listening on http://{host}:{port}")
     print("Endpoints: POST /create-k, POST /recover-card")
     try:
@@ -118,15 +326,57 @@ def run_server(host: str = "127.0.0.1", port: int = 8787) -> None:
         pass
     finally:
         server.server_close()
+        if access_log is not None:
+            access_log.close()
 
 
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(description="FingerPay local API for extension integration")
     parser.add_argument("--host", default="127.0.0.1", help="Bind host (default: 127.0.0.1)")
     parser.add_argument("--port", type=int, default=8787, help="Bind port (default: 8787)")
+    parser.add_argument("--access-log", help="Write JSON-lines access log to this path")
+    parser.add_argument(
+        "--access-log-sample-rate",
+        type=float,
+        default=1.0,
+        help="Fraction of requests to log, 0-1 (default: 1.0)",
+    )
+    parser.add_argument(
+        "--access-log-max-bytes",
+        type=int,
+        default=10 * 1024 * 1024,
+        help="Rotate the access log at this size (default: 10 MiB)",
+    )
+    parser.add_argument(
+        "--idempotency-ttl",
+        type=float,
+        default=600.0,
+        help="Seconds to remember Idempotency-Key results for /create-k; 0 disables (default: 600)",
+    )
+    parser.add_argument(
+        "--idempotency-max-entries",
+        type=int,
+        default=1024,
+        help="Maximum remembered Idempotency-Key results; 0 disables (default: 1024)",
+    )
     args = parser.parse_args(argv)
+    if args.idempotency_ttl < 0:
+        parser.error("--idempotency-ttl must be >= 0")
+    if args.idempotency_max_entries < 0:
+        parser.error("--idempotency-max-entries must be >= 0")
 
-    run_server(args.host, args.port)
+    access_log = None
+    if args.access_log:
+        access_log = AccessLog(
+            args.access_log,
+            sample_rate=args.access_log_sample_rate,
+            max_bytes=args.access_log_max_bytes,
+        )
+    idempotency_cache = IdempotencyCache(
+        max_entries=args.idempotency_max_entries,
+        ttl_seconds=args.idempotency_ttl,
+    )
+    run_server(args.host, args.port, access_log, idempotency_cache)
     return 0
 
 
@@ -0,0 +1,217 @@
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+from fingerpay.access_log import AccessLog
+from fingerpay.api import FingerPayAPIHandler, ThreadingHTTPServer
+
+
+def _read_lines(path: Path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def _serve_with_log(handler: type, log: AccessLog) -> tuple[ThreadingHTTPServer, threading.Thread, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.access_log = log
+    # Non-daemon handler threads are joined by server_close(), so every
+    # request has been logged before the test closes the AccessLog.
+    server.daemon_threads = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    return server, thread, f"http://{host}:{port}"
+
+
+def _stop(server: ThreadingHTTPServer, thread: threading.Thread) -> None:
+    server.shutdown()
+    server.server_close()
+    thread.join(timeout=2)
+
+
+def test_records_are_written_as_json_lines(tmp_path: Path) -> None:
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path))
+    log.start()
+    log.record("POST", "/create-k", 200, 0.25, 0.2, 50, 300, "127.0.0.1")
+    log.record("POST", "/recover-card", 400, 0.1, 0.09, 60, 40, "127.0.0.1")
+    log.close()
+
+    lines = _read_lines(path)
+    assert [line["route"] for line in lines] == ["/create-k", "/recover-card"]
+    assert lines[0]["status"] == 200
+    assert lines[0]["latency_ms"] == 250.0
+    assert lines[0]["kdf_ms"] == 200.0
+    assert lines[0]["bytes_out"] == 300
+    assert lines[0]["client"] == lines[1]["client"]
+    assert "127.0.0.1" not in path.read_text(encoding="utf-8")
+
+
+def test_zero_sample_rate_skips_records(tmp_path: Path) -> None:
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), sample_rate=0.0)
+    log.start()
+    for _ in range(10):
+        log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    log.close()
+
+    assert path.read_text(encoding="utf-8") == ""
+
+
+def test_rotates_when_max_bytes_exceeded(tmp_path: Path) -> None:
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), max_bytes=1, batch_size=1, backup_count=2)
+    log.start()
+    for _ in range(4):
+        log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    log.close()
+
+    assert len(_read_lines(path)) == 1
+    assert (tmp_path / "access.log.1").exists()
+    assert (tmp_path / "access.log.2").exists()
+    assert not (tmp_path / "access.log.3").exists()
+
+
+def test_api_logs_without_sensitive_fields(tmp_path: Path) -> None:
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path))
+    log.start()
+    server, thread, base_url = _serve_with_log(FingerPayAPIHandler, log)
+
+    req = urllib.request.Request(
+        f"{base_url}/create-k",
+        data=json.dumps({"card": "4242424242424242", "pin": "1234"}).encode("utf-8"),
+        method="POST",
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=3) as resp:
+        k_token = json.loads(resp.read().decode("utf-8"))["k_token"]
+
+    _stop(server, thread)
+    log.close()
+
+    text = path.read_text(encoding="utf-8")
+    assert "4242424242424242" not in text
+    assert k_token not in text
+    (line,) = _read_lines(path)
+    assert line["route"] == "/create-k"
+    assert line["status"] == 200
+    assert line["kdf_ms"] > 0
+    assert line["bytes_in"] > 0
+    assert line["bytes_out"] > len(k_token)
+
+
+def test_unwritable_path_fails_at_start(tmp_path: Path) -> None:
+    log = AccessLog(str(tmp_path))
+    with pytest.raises(OSError):
+        log.start()
+    log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    assert log._queue.qsize() == 0
+
+
+def test_record_is_noop_when_not_running(tmp_path: Path) -> None:
+    log = AccessLog(str(tmp_path / "access.log"))
+    log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    assert log._queue.qsize() == 0
+
+    log.start()
+    log.close()
+    log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    assert log._queue.qsize() == 0
+
+
+def test_write_errors_are_reported_once_and_queue_keeps_draining(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    log = AccessLog(str(tmp_path / "access.log"), max_bytes=1, batch_size=1)
+
+    def fail_rotate() -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(log, "_rotate", fail_rotate)
+    log.start()
+    for _ in range(5):
+        log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    log.close()
+
+    assert log._queue.qsize() == 0
+    assert capsys.readouterr().err.count("disk full") == 1
+
+
+def test_records_past_max_queue_are_dropped(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    log = AccessLog(str(tmp_path / "access.log"), batch_size=1, max_queue=2)
+    entered = threading.Event()
+    release = threading.Event()
+    original_format = log._format
+
+    def slow_format(entry: tuple) -> str:
+        entered.set()
+        release.wait(timeout=2)
+        return original_format(entry)
+
+    monkeypatch.setattr(log, "_format", slow_format)
+    log.start()
+    log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    assert entered.wait(timeout=2)
+    for _ in range(5):
+        log.record("POST", "/create-k", 200, 0.1, 0.1, 1, 1, "127.0.0.1")
+    release.set()
+    log.close()
+
+    assert log.dropped == 3
+    assert len(_read_lines(tmp_path / "access.log")) == 3
+
+
+def test_api_logs_requests_rejected_by_base_handler(tmp_path: Path) -> None:
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path))
+    log.start()
+    server, thread, base_url = _serve_with_log(FingerPayAPIHandler, log)
+
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        urllib.request.urlopen(f"{base_url}/create-k", timeout=3)
+    assert excinfo.value.code == 501
+
+    _stop(server, thread)
+    log.close()
+
+    (line,) = _read_lines(path)
+    assert line["method"] == "GET"
+    assert line["route"] == "/create-k"
+    assert line["status"] == 501
+
+
+def test_api_logs_aborted_requests(tmp_path: Path) -> None:
+    class AbortingHandler(FingerPayAPIHandler):
+        def _dispatch_post(self) -> None:
+            self._status = 200
+            raise BrokenPipeError
+
+        def log_error(self, format: str, *args: object) -> None:
+            return
+
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path))
+    log.start()
+    server, thread, base_url = _serve_with_log(AbortingHandler, log)
+    server.handle_error = lambda request, client_address: None
+
+    req = urllib.request.Request(
+        f"{base_url}/create-k",
+        data=b"{}",
+        method="POST",
+        headers={"Content-Type": "application/json"},
+    )
+    with pytest.raises((urllib.error.URLError, ConnectionError, http.client.HTTPException)):
+        urllib.request.urlopen(req, timeout=3)
+
+    _stop(server, thread)
+    log.close()
+
+    (line,) = _read_lines(path)
+    assert line["route"] == "/create-k"
+    assert line["bytes_out"] == 0
@@ -1,19 +1,31 @@
 import json
 import threading
+import time
 import urllib.error
 import urllib.request
 
 import pytest
 
-from fingerpay.api import FingerPayAPIHandler, ThreadingHTTPServer
+from fingerpay.api import (
+    FingerPayAPIHandler,
+    IdempotencyCache,
+    IdempotencyConflict,
+    ThreadingHTTPServer,
+    main,
+)
 
 
-def _post_json(base_url: str, path: str, payload: dict[str, str]) -> tuple[int, dict[str, str]]:
+def _post_json(
+    base_url: str,
+    path: str,
+    payload: dict[str, str],
+    headers: dict[str, str] | None = None,
+) -> tuple[int, dict[str, str]]:
     req = urllib.request.Request(
         f"{base_url}{path}",
         data=json.dumps(payload).encode("utf-8"),
         method="POST",
-        headers={"Content-Type": "application/json"},
+        headers={"Content-Type": "application/json", **(headers or {})},
     )
 
     try:
@@ -28,6 +40,7 @@ def _post_json(base_url: str, path: str, payload: dict[str, str]) -> tuple[int,
 @pytest.fixture
 def api_server() -> str:
     server = ThreadingHTTPServer(("127.0.0.1", 0), FingerPayAPIHandler)
+    server.idempotency_cache = IdempotencyCache()
     thread = threading.Thread(target=server.serve_forever, daemon=True)
     thread.start()
 
@@ -74,3 +87,189 @@ def test_recover_wrong_pin_returns_400(api_server: str) -> None:
     )
     assert status == 400
     assert "Invalid PIN" in recovered["error"]
+
+
+def test_create_k_with_idempotency_key_returns_original_token(api_server: str) -> None:
+    payload = {"card": "4242424242424242", "pin": "1234"}
+    headers = {"Idempotency-Key": "4b0c1f3e-retry-0001"}
+
+    status, first = _post_json(api_server, "/create-k", payload, headers)
+    assert status == 200
+    status, second = _post_json(api_server, "/create-k", payload, headers)
+    assert status == 200
+    assert second["k_token"] == first["k_token"]
+
+    status, other = _post_json(api_server, "/create-k", payload)
+    assert status == 200
+    assert other["k_token"] != first["k_token"]
+
+
+def test_create_k_idempotency_key_reuse_with_different_body_returns_422(api_server: str) -> None:
+    headers = {"Idempotency-Key": "4b0c1f3e-retry-0002"}
+    status, _ = _post_json(api_server, "/create-k", {"card": "4242424242424242", "pin": "1234"}, headers)
+    assert status == 200
+
+    status, body = _post_json(api_server, "/create-k", {"card": "4242424242424242", "pin": "9999"}, headers)
+    assert status == 422
+    assert "Idempotency-Key" in body["error"]
+
+
+def test_idempotency_cache_single_flight() -> None:
+    cache = IdempotencyCache()
+    calls = []
+    release = threading.Event()
+
+    def compute() -> str:
+        calls.append(1)
+        release.wait(timeout=2)
+        return "token"
+
+    results: list[str] = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.run("127.0.0.1", "k", "fp", compute)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=2)
+
+    assert results == ["token"] * 5
+    assert len(calls) == 1
+
+
+def test_idempotency_cache_does_not_keep_failures() -> None:
+    cache = IdempotencyCache()
+
+    def fail() -> str:
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        cache.run("127.0.0.1", "k", "fp", fail)
+    assert cache.run("127.0.0.1", "k", "fp", lambda: "token") == "token"
+
+
+def test_idempotency_cache_ttl_and_lru_eviction() -> None:
+    cache = IdempotencyCache(max_entries=2, ttl_seconds=60)
+    cache.run("127.0.0.1", "a", "fp", lambda: "a1")
+    cache.run("127.0.0.1", "b", "fp", lambda: "b1")
+    assert cache.run("127.0.0.1", "a", "fp", lambda: "a2") == "a1"
+    with pytest.raises(IdempotencyConflict):
+        cache.run("127.0.0.1", "a", "other", lambda: "a3")
+    cache.run("127.0.0.1", "c", "fp", lambda: "c1")
+    assert cache.run("127.0.0.1", "b", "fp", lambda: "b2") == "b2"
+
+    expiring = IdempotencyCache(ttl_seconds=0)
+    expiring.run("127.0.0.1", "a", "fp", lambda: "a1")
+    assert expiring.run("127.0.0.1", "a", "fp", lambda: "a2") == "a2"
+
+
+def test_create_k_rejects_short_idempotency_key(api_server: str) -> None:
+    status, body = _post_json(
+        api_server,
+        "/create-k",
+        {"card": "4242424242424242", "pin": "1234"},
+        {"Idempotency-Key": "retry-1"},
+    )
+    assert status == 400
+    assert "Idempotency-Key" in body["error"]
+
+
+def test_idempotency_cache_is_scoped_to_caller() -> None:
+    cache = IdempotencyCache()
+    assert cache.run("10.0.0.1", "k", "fp", lambda: "first") == "first"
+    assert cache.run("10.0.0.2", "k", "other", lambda: "second") == "second"
+
+
+def test_idempotency_cache_does_not_keep_base_exceptions() -> None:
+    cache = IdempotencyCache()
+
+    def interrupted() -> str:
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.run("127.0.0.1", "k", "fp", interrupted)
+    assert cache.run("127.0.0.1", "k", "fp", lambda: "token") == "token"
+
+
+def test_idempotency_cache_does_not_evict_in_flight_entries() -> None:
+    cache = IdempotencyCache(max_entries=1)
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute() -> str:
+        calls.append(1)
+        started.set()
+        release.wait(timeout=2)
+        return "token"
+
+    results: list[str] = []
+    leader = threading.Thread(target=lambda: results.append(cache.run("127.0.0.1", "a", "fp", compute)))
+    leader.start()
+    assert started.wait(timeout=2)
+
+    cache.run("127.0.0.1", "b", "fp", lambda: "b1")
+    follower = threading.Thread(target=lambda: results.append(cache.run("127.0.0.1", "a", "fp", compute)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(timeout=2)
+    follower.join(timeout=2)
+
+    assert results == ["token", "token"]
+    assert len(calls) == 1
+
+
+def test_idempotency_cache_mismatch_pays_for_kdf() -> None:
+    cache = IdempotencyCache()
+    calls = []
+
+    def compute() -> str:
+        calls.append(1)
+        return "token"
+
+    cache.run("127.0.0.1", "k", "fp", compute)
+    with pytest.raises(IdempotencyConflict):
+        cache.run("127.0.0.1", "k", "other", compute)
+    assert len(calls) == 2
+    assert cache.run("127.0.0.1", "k", "fp", compute) == "token"
+    assert len(calls) == 2
+
+
+def test_idempotency_cache_zero_limits_disable_cache() -> None:
+    assert not IdempotencyCache(max_entries=0).enabled
+    assert not IdempotencyCache(ttl_seconds=0).enabled
+    assert IdempotencyCache().enabled
+    with pytest.raises(ValueError):
+        IdempotencyCache(max_entries=-1)
+    with pytest.raises(ValueError):
+        IdempotencyCache(ttl_seconds=-1)
+
+
+@pytest.mark.parametrize("flag", ["--idempotency-ttl", "--idempotency-max-entries"])
+def test_main_rejects_negative_idempotency_limits(flag: str) -> None:
+    with pytest.raises(SystemExit):
+        main([flag, "-1"])
+
+
+def test_create_k_with_disabled_cache_recomputes() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FingerPayAPIHandler)
+    server.idempotency_cache = IdempotencyCache(max_entries=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    base_url = f"http://{host}:{port}"
+
+    payload = {"card": "4242424242424242", "pin": "1234"}
+    headers = {"Idempotency-Key": "4b0c1f3e-retry-0003"}
+    _, first = _post_json(base_url, "/create-k", payload, headers)
+    _, second = _post_json(base_url, "/create-k", payload, headers)
+
+    server.shutdown()
+    server.server_close()
+    thread.join(timeout=2)
+
+    assert first["k_token"] != second["k_token"]